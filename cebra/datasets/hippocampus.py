@@ -21,12 +21,16 @@ References:
 
 """
 
+import functools
+import glob
 import hashlib
 import os
+import warnings
 
 import joblib
 import numpy as np
 import scipy.io
+import sklearn.metrics
 import sklearn.model_selection
 import sklearn.neighbors
 import torch
@@ -39,6 +43,116 @@ from cebra.datasets import register
 
 _DEFAULT_DATADIR = get_datapath()
 
+# NOTE: Increase this version whenever the format or content of the cached
+# splits of SingleRatTrialSplitDataset changes.
+_SPLIT_CACHE_VERSION = 1
+
+# NOTE: Set this environment variable to change the directory of the cached
+# splits, or to an empty string to disable caching.
+_SPLIT_CACHE_DIR_ENV = "CEBRA_HIPPOCAMPUS_CACHE_DIR"
+_split_cache_warning_issued = False
+
+
+def _load_rat(path):
+    """Load the neural and behavior tensors of a single rat recording.
+
+    The result is cached, so that datasets constructed from the same file
+    (e.g. the train, valid and test splits) only read it once. The cache is
+    keyed by the size and modification time of the file, so that changes to
+    the recording are picked up. The returned tensors are shared between
+    callers and must not be modified in place.
+
+    Args:
+        path: The path to the ``.jl`` file of the recording.
+
+    Returns:
+        A tuple of the neural data and the behavior label as float tensors.
+    """
+    stat = os.stat(path)
+    return _load_rat_cached(path, stat.st_size, stat.st_mtime_ns)
+
+
+def _is_compressed(path):
+    """Return whether the joblib file at the given path is compressed."""
+    # NOTE: Uncompressed joblib files are plain pickles, which start with the
+    # PROTO opcode (protocol 2 and higher), while compressed files start with
+    # the header of the compression format.
+    with open(path, "rb") as f:
+        return f.read(1) != b"\x80"
+
+
+@functools.lru_cache(maxsize=8)
+def _load_rat_cached(path, size, mtime_ns):
+    """Cached implementation of :py:func:`_load_rat`."""
+    # NOTE: Uncompressed files are memory-mapped, so only the converted copies
+    # below are held in memory, not the deserialized arrays themselves.
+    # Compressed files cannot be memory-mapped and are loaded regularly.
+    mmap_mode = None if _is_compressed(path) else "r"
+    data = joblib.load(path, mmap_mode=mmap_mode)
+    neural = torch.from_numpy(np.array(data["spikes"], dtype=np.float32))
+    index = torch.from_numpy(np.array(data["position"], dtype=np.float32))
+    return neural, index
+
+
+def _gather_trials(data, trial_bounds):
+    """Concatenate the rows of the given trials into a single tensor.
+
+    The output is allocated once and each trial is copied into it as a
+    contiguous block of rows.
+
+    Args:
+        data: The tensor to gather the rows from.
+        trial_bounds: An array of shape ``num_trials x 2`` with the start and
+            end row of each trial.
+
+    Returns:
+        A tensor with the rows of all trials, in the given order.
+    """
+    trial_lengths = trial_bounds[:, 1] - trial_bounds[:, 0]
+    out = torch.empty((int(trial_lengths.sum()), *data.shape[1:]),
+                      dtype=data.dtype,
+                      device=data.device)
+    offset = 0
+    for start, end in trial_bounds.tolist():
+        out[offset:offset + end - start].copy_(data[start:end])
+        offset += end - start
+    return out
+
+
+def _nearest_neighbors(x_train, x_test, n_neighbors, backend="exact"):
+    """Return the indices of the nearest train samples for each test sample.
+
+    Args:
+        x_train: The train set data
+        x_test: The test set data
+        n_neighbors: The number of neighbors to return per test sample.
+        backend: Either 'exact' or 'hnsw', see
+            :py:meth:`SingleRatDataset.decode`.
+
+    Returns:
+        An integer array of shape ``len(x_test) x n_neighbors``, with neighbors
+        sorted by increasing distance.
+    """
+    if backend == "exact":
+        knn = sklearn.neighbors.NearestNeighbors(n_neighbors=n_neighbors,
+                                                 n_jobs=-1)
+        knn.fit(x_train)
+        return knn.kneighbors(x_test, return_distance=False)
+    elif backend == "hnsw":
+        import hnswlib
+
+        x_train = np.asarray(x_train, dtype=np.float32)
+        x_test = np.asarray(x_test, dtype=np.float32)
+        index = hnswlib.Index(space="l2", dim=x_train.shape[1])
+        index.init_index(max_elements=len(x_train), ef_construction=200, M=16)
+        index.add_items(x_train)
+        index.set_ef(2 * n_neighbors)
+        labels, _ = index.knn_query(x_test, k=n_neighbors)
+        return labels.astype(np.int64)
+    else:
+        raise ValueError(
+            f"'{backend}' is not a valid backend. Use 'exact' or 'hnsw'.")
+
 
 @register("rat-hippocampus-single")
 @parametrize(
@@ -58,15 +172,18 @@ class SingleRatDataset(cebra.data.SingleSessionDataset):
 
     def __init__(self, name="achilles", root=_DEFAULT_DATADIR):
         super().__init__()
-        path = os.path.join(root, f"rat_hippocampus/{name}.jl")
-        data = joblib.load(path)
-        self.neural = torch.from_numpy(data["spikes"]).float()
-        self.index = torch.from_numpy(data["position"]).float()
         self.name = name
+        self.path = os.path.join(root, "rat_hippocampus", f"{name}.jl")
+        self._load()
+
+    def _load(self):
+        """Load the neural data and behavior label from the recording."""
+        self.neural, self.index = _load_rat(self.path)
+        self._len, self._input_dimension = self.neural.shape
 
     @property
     def input_dimension(self):
-        return self.neural.size(1)
+        return self._input_dimension
 
     @property
     def continuous_index(self):
@@ -78,12 +195,12 @@ class SingleRatDataset(cebra.data.SingleSessionDataset):
         return self.neural[index].transpose(2, 1)
 
     def __len__(self):
-        return len(self.neural)
+        return self._len
 
     def __repr__(self):
         return f"RatDataset(name: {self.name}, shape: {self.neural.shape})"
 
-    def decode(self, x_train, y_train, x_test, y_test):
+    def decode(self, x_train, y_train, x_test, y_test, backend="exact"):
         """kNN decoding function.
 
         Perform a kNN decoding for n_neighbors = 1,4,9,26,25 with the given train set and test set.
@@ -93,19 +210,35 @@ class SingleRatDataset(cebra.data.SingleSessionDataset):
             y_train: The train set label
             x_test: The test set data
             y_test: The test set label
+            backend: The nearest neighbor search to use. Choose among 'exact'
+                (default), which uses
+                :py:class:`sklearn.neighbors.NearestNeighbors`, and 'hnsw',
+                which uses an approximate search from the optional ``hnswlib``
+                package and scales better to large train sets.
 
         """
 
         nn = np.power(np.linspace(1, 10, 6, dtype=int), 2)
+        y_train = np.asarray(y_train)
+        y_test = np.asarray(y_test)
+
+        # NOTE: The neighbors for all values of n are obtained from a single
+        # query with the largest n, since the k nearest neighbors are a prefix
+        # of the (k+1) nearest neighbors.
+        neighbors = _nearest_neighbors(x_train,
+                                       x_test,
+                                       n_neighbors=int(nn.max()),
+                                       backend=backend)
+
+        preds = np.stack([
+            np.take(y_train, neighbors[:, :n], axis=0).mean(axis=1) for n in nn
+        ])
+        errs = np.median(np.abs(preds[:, :, 0] - y_test[None, :, 0]), axis=1)
+
         metric = {}
-        for n in nn:
-            knn = sklearn.neighbors.KNeighborsRegressor(n_neighbors=n)
-            knn.fit(x_train, y_train)
-            pred = knn.predict(x_test)
-            err = np.median(abs(pred[:, 0] - y_test[:, 0]))
-            score = knn.score(x_test, y_test)
+        for n, pred, err in zip(nn, preds, errs):
             metric[f"n{n}_err"] = err
-            metric[f"n{n}_r2"] = score
+            metric[f"n{n}_r2"] = sklearn.metrics.r2_score(y_test, pred)
         return metric
 
 
@@ -126,6 +259,11 @@ class SingleRatTrialSplitDataset(SingleRatDataset):
         name: The name of a rat to use. Choose among 'achilles', 'buddy', 'cicero' and 'gatsby'.
         split_no: The `k` for k-fold split. Choose among 0, 1, 2.
         split: The split to use. Choose among 'train', 'valid', 'test', 'all', and 'wo_test'(all trials except test split).
+        cache_dir: The directory to cache computed splits in. By default, the
+            ``CEBRA_HIPPOCAMPUS_CACHE_DIR`` environment variable is used if
+            set, and ``{root}/rat_hippocampus/_cache`` otherwise. Pass
+            ``False``, or set the environment variable to an empty string, to
+            disable caching.
 
     """
 
@@ -133,27 +271,119 @@ class SingleRatTrialSplitDataset(SingleRatDataset):
                  name="achilles",
                  split_no=0,
                  split=None,
-                 root=_DEFAULT_DATADIR):
-        super().__init__(name=name, root=root)
+                 root=_DEFAULT_DATADIR,
+                 cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get(
+                _SPLIT_CACHE_DIR_ENV,
+                os.path.join(root, "rat_hippocampus", "_cache"))
+        # NOTE: The split is needed in _load, which is called by the parent
+        # constructor, to be able to skip loading the full recording.
         self.split_no = split_no
         self.split_name = split
-        if split is not None:
-            self._split(split)
+        self.cache_dir = cache_dir or None
+        super().__init__(name=name, root=root)
+
+    def _load(self):
+        if self.split_name is None:
+            super()._load()
+        else:
+            self._split(self.split_name)
 
     def _split(self, split, **kwargs):
         """Split the dataset into 3-fold nested cross validation scheme.
 
         The recordings are parsed into trials and split into a train, valid, test set with 3-fold nested cross validation scheme.
 
+        After splitting, ``selected_indices`` holds the rows of the full
+        recording which are part of the split as a ``torch.int64`` tensor, and
+        ``selected_slices`` holds the same rows as one ``slice`` per trial.
+
+        The split is always computed from the full recording. Unless disabled,
+        the split data is cached in ``cache_dir``, and reused by later instances
+        with the same name, ``split_no`` and split without reading the
+        recording again.
+
         Args:
             split: The split to use. Choose among 'train', 'valid', 'test', 'all', and 'wo_test'(all trials except test split).
 
         """
 
-        direction_change_idx = np.where(
-            self.index[1:, 1] != self.index[:-1, 1])[0]
+        if self.cache_dir is None:
+            split_data = self._compute_split(split, *_load_rat(self.path))
+        else:
+            split_data = self._load_cached_split(split)
+
+        self.neural = split_data["neural"]
+        self.index = split_data["index"]
+        self._len, self._input_dimension = self.neural.shape
+        self.selected_indices = split_data["selected_indices"]
+        self.selected_slices = tuple(
+            slice(start, end)
+            for start, end in split_data["trial_bounds"].tolist())
+        self.concat_idx = split_data["concat_idx"].numpy()
+
+    def _load_cached_split(self, split):
+        """Load the split from ``cache_dir``, or compute and cache it.
+
+        Splits cached for previous versions of the recording are removed when
+        the split is cached again. If the split cannot be cached, a warning is
+        issued once per process.
+        """
+        global _split_cache_warning_issued
+
+        stat = os.stat(self.path)
+        key = hashlib.md5(f"{_SPLIT_CACHE_VERSION}|{self.path}|{stat.st_size}|"
+                          f"{stat.st_mtime_ns}".encode()).hexdigest()
+        prefix = f"{self.name}-{self.split_no}-{split}-"
+        cache_path = os.path.join(self.cache_dir, f"{prefix}{key}.pt")
+        if os.path.exists(cache_path):
+            return torch.load(cache_path, map_location="cpu")
+
+        split_data = self._compute_split(split, *_load_rat(self.path))
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            torch.save(split_data, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            if not _split_cache_warning_issued:
+                _split_cache_warning_issued = True
+                warnings.warn(
+                    f"Could not cache the split to {cache_path}: {e}. "
+                    f"Set {_SPLIT_CACHE_DIR_ENV} to a writable directory, or "
+                    f"to an empty string to disable caching.")
+            return split_data
+
+        stale_paths = glob.glob(
+            os.path.join(glob.escape(self.cache_dir),
+                         f"{glob.escape(prefix)}*.pt"))
+        for stale_path in stale_paths:
+            if stale_path != cache_path:
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
+        return split_data
+
+    def _compute_split(self, split, neural, index):
+        """Compute the data of the given split, see :py:meth:`_split`.
+
+        Args:
+            split: The split to compute.
+            neural: The neural data of the full recording.
+            index: The behavior label of the full recording.
+
+        Returns:
+            A dictionary of tensors with the split ``neural`` data and
+            ``index``, the ``selected_indices``, the start and end row of each
+            selected trial (``trial_bounds``) and the ``concat_idx``.
+        """
+
+        direction_change_idx = torch.nonzero(torch.diff(index[:, 1]),
+                                             as_tuple=True)[0].numpy()
         trial_change_idx = np.append(
-            np.insert(direction_change_idx[1::2], 0, 0), len(self.index))
+            np.insert(direction_change_idx[1::2], 0, 0), len(index))
         total_trials_num = len(trial_change_idx) - 1
 
         outer_folds = np.array_split(
@@ -164,17 +394,15 @@ class SingleRatTrialSplitDataset(SingleRatDataset):
                                                     shuffle=False)
         ## in each outer fold array, make train, valid, test split
 
-        train_trials = []
-        valid_trials = []
-        test_trials = []
-
+        fold_splits = []
         for out_fold in outer_folds:
             train_trial, val_test_trial = list(
                 inner_folds.split(out_fold))[self.split_no]
             test_trial, valid_trial = np.array_split(val_test_trial, 2)
-            train_trials.extend(np.array(out_fold)[train_trial])
-            valid_trials.extend(np.array(out_fold)[valid_trial])
-            test_trials.extend(np.array(out_fold)[test_trial])
+            fold_splits.append((out_fold[train_trial], out_fold[valid_trial],
+                                out_fold[test_trial]))
+        train_trials, valid_trials, test_trials = (
+            np.concatenate(trials) for trials in zip(*fold_splits))
 
         if split == "train":
             trials = train_trials
@@ -190,21 +418,25 @@ class SingleRatTrialSplitDataset(SingleRatDataset):
             raise ValueError(
                 f"'{split}' is not a valid split. Use 'train', 'valid' or 'test'"
             )
-        self.selected_indices = tuple(
-            slice(trial_change_idx[i], trial_change_idx[i + 1]) for i in trials)
-        self.neural = torch.cat([
-            self.neural[trial_change_idx[i]:trial_change_idx[i + 1]]
-            for i in trials
-        ])
-        self.index = torch.cat([
-            self.index[trial_change_idx[i]:trial_change_idx[i + 1]]
-            for i in trials
-        ])
-
-        cumulated_len = np.cumsum(
-            [trial_change_idx[i + 1] - trial_change_idx[i] for i in trials])
-        self.concat_idx = cumulated_len[:-1][np.array(trials[:-1]) +
-                                             1 != trials[1:]]
+        trials = np.asarray(trials, dtype=np.int64)
+        trial_bounds = np.stack(
+            [trial_change_idx[trials], trial_change_idx[trials + 1]],
+            axis=1).astype(np.int64)
+        selected_indices = torch.from_numpy(
+            np.concatenate(
+                [np.arange(start, end) for start, end in trial_bounds]))
+
+        trial_lengths = trial_bounds[:, 1] - trial_bounds[:, 0]
+        cumulated_len = np.cumsum(trial_lengths)
+        concat_idx = cumulated_len[:-1][np.diff(trials) != 1]
+
+        return {
+            "neural": _gather_trials(neural, trial_bounds),
+            "index": _gather_trials(index, trial_bounds),
+            "selected_indices": selected_indices,
+            "trial_bounds": torch.from_numpy(trial_bounds),
+            "concat_idx": torch.from_numpy(concat_idx),
+        }
 
 
 @parametrize(
@@ -226,10 +458,10 @@ class SingleRatCorruptDataset(SingleRatDataset):
 
     def __init__(self, name, seed, root=_DEFAULT_DATADIR):
         super().__init__(name=name, root=root)
-        rng = np.random.Generator(np.random.PCG64(seed))
-        shuffled_index = np.arange(len(self.index))
-        rng.shuffle(shuffled_index)
-        self.index = self.index[shuffled_index]
+        generator = torch.Generator()
+        generator.manual_seed(int(seed))
+        shuffled_index = torch.randperm(len(self.index), generator=generator)
+        self.index = self.index.index_select(0, shuffled_index)
 
 
 @register("rat-hippocampus-multisubjects-3fold-trial-split")
@@ -246,16 +478,21 @@ class MultipleRatsTrialSplitDataset(cebra.data.DatasetCollection):
     Args:
         split_no: The `k` for k-fold split. Choose among 0, 1, and 2.
         split: The split to use. Choose among 'train', 'valid', 'test', 'all', and 'wo_test'(all trials except test split).
+        cache_dir: The directory to cache computed splits in, see
+            :py:class:`SingleRatTrialSplitDataset`.
 
     """
 
-    def __init__(self, split_no=0, split=None):
-        super().__init__(
-            *[
-                init(f"rat-hippocampus-{name}-3fold-trial-split-{split_no}",
-                     split=split)
-                for name in ["achilles", "buddy", "cicero", "gatsby"]
-            ],)
+    def __init__(self, split_no=0, split=None, cache_dir=None):
+        # NOTE: The rats are loaded and split independently, so we use threads
+        # to overlap the file I/O of the individual recordings.
+        datasets = joblib.Parallel(n_jobs=4, backend="threading")(
+            joblib.delayed(init)(
+                f"rat-hippocampus-{name}-3fold-trial-split-{split_no}",
+                split=split,
+                cache_dir=cache_dir)
+            for name in ["achilles", "buddy", "cicero", "gatsby"])
+        super().__init__(*datasets)
         self.names = [dataset.name for dataset in self._datasets]
         self.shapes = [dataset.neural.shape for dataset in self._datasets]
         self._split = split
@@ -9,6 +9,10 @@
 # Please see LICENSE.md for the full license document:
 # https://github.com/AdaptiveMotorControlLab/CEBRA/LICENSE.md
 #
+import os
+import warnings
+
+import joblib
 import numpy as np
 import pytest
 import torch
@@ -279,3 +283,279 @@ def test_poisson_sampling(spike_rate, refractory_period):
         refractory_period=refractory_period)
 
     _assert_histograms_close(spike_counts.flatten().numpy(), reference_counts)
+
+
+def test_hippocampus_decode(tmp_path):
+    import sklearn.neighbors
+
+    from cebra.datasets import hippocampus
+
+    rng = np.random.default_rng(0)
+    x_train, x_test = rng.normal(size=(500, 8)), rng.normal(size=(100, 8))
+    y_train, y_test = rng.normal(size=(500, 3)), rng.normal(size=(100, 3))
+
+    _write_rat_recording(tmp_path)
+    dataset = hippocampus.SingleRatDataset(name="synthetic", root=str(tmp_path))
+    metric = dataset.decode(x_train, y_train, x_test, y_test)
+
+    for n in np.power(np.linspace(1, 10, 6, dtype=int), 2):
+        knn = sklearn.neighbors.KNeighborsRegressor(n_neighbors=n)
+        knn.fit(x_train, y_train)
+        pred = knn.predict(x_test)
+        assert np.isclose(metric[f"n{n}_err"],
+                          np.median(abs(pred[:, 0] - y_test[:, 0])))
+        assert np.isclose(metric[f"n{n}_r2"], knn.score(x_test, y_test))
+
+
+def test_hippocampus_decode_backend(tmp_path):
+    from cebra.datasets import hippocampus
+
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=(200, 8)), rng.normal(size=(200, 3))
+    _write_rat_recording(tmp_path)
+    dataset = hippocampus.SingleRatDataset(name="synthetic", root=str(tmp_path))
+
+    with pytest.raises(ValueError, match="backend"):
+        dataset.decode(x, y, x, y, backend="invalid")
+
+    pytest.importorskip("hnswlib")
+    exact = dataset.decode(x, y, x, y)
+    approximate = dataset.decode(x, y, x, y, backend="hnsw")
+    assert exact.keys() == approximate.keys()
+    for key in exact:
+        assert np.isclose(exact[key], approximate[key], rtol=1e-4), key
+
+
+def _write_rat_recording(root, name="synthetic", seed=0, compress=0):
+    """Write a synthetic recording in the rat hippocampus dataset format."""
+    rng = np.random.default_rng(seed)
+    # Running direction alternates between segments of random length, giving
+    # one trial per two segments.
+    segment_lengths = rng.integers(5, 15, size=40)
+    direction = np.repeat(np.arange(len(segment_lengths)) % 2, segment_lengths)
+    num_samples = len(direction)
+    position = np.stack(
+        [rng.uniform(size=num_samples), direction, 1 - direction], axis=1)
+    spikes = rng.poisson(1.0, size=(num_samples, 6)).astype(np.float64)
+
+    path = root / "rat_hippocampus" / f"{name}.jl"
+    path.parent.mkdir(exist_ok=True)
+    data = {"spikes": spikes, "position": position}
+    joblib.dump(data, path, compress=compress)
+    return path
+
+
+def test_hippocampus_split_cache(tmp_path, monkeypatch):
+    from cebra.datasets import hippocampus
+
+    monkeypatch.delenv(hippocampus._SPLIT_CACHE_DIR_ENV, raising=False)
+    path = _write_rat_recording(tmp_path)
+    cache_dir = tmp_path / "rat_hippocampus" / "_cache"
+
+    def _init():
+        return hippocampus.SingleRatTrialSplitDataset(name="synthetic",
+                                                      split_no=1,
+                                                      split="train",
+                                                      root=str(tmp_path))
+
+    first = _init()
+    assert len(list(cache_dir.glob("*.pt"))) == 1
+
+    # A cache hit must not read the recording.
+    with monkeypatch.context() as patch:
+        patch.setattr(hippocampus, "_load_rat", None)
+        second = _init()
+    assert len(list(cache_dir.glob("*.pt"))) == 1
+    assert torch.equal(first.neural, second.neural)
+    assert torch.equal(first.index, second.index)
+    assert torch.equal(first.selected_indices, second.selected_indices)
+    assert first.selected_slices == second.selected_slices
+    assert np.array_equal(first.concat_idx, second.concat_idx)
+    assert len(second) == len(first)
+    assert second.input_dimension == first.input_dimension
+
+    # Changing the recording invalidates the cache and removes the old file.
+    old_cache_paths = list(cache_dir.glob("*.pt"))
+    stat = os.stat(path)
+    _write_rat_recording(tmp_path, seed=1)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    third = _init()
+    cache_paths = list(cache_dir.glob("*.pt"))
+    assert len(cache_paths) == 1
+    assert cache_paths != old_cache_paths
+    assert not torch.equal(first.index, third.index)
+
+
+def test_hippocampus_split_cache_unwritable(tmp_path, monkeypatch):
+    from cebra.datasets import hippocampus
+
+    monkeypatch.delenv(hippocampus._SPLIT_CACHE_DIR_ENV, raising=False)
+    monkeypatch.setattr(hippocampus, "_split_cache_warning_issued", False)
+    _write_rat_recording(tmp_path)
+    # A file in place of the cache directory makes the cache unwritable.
+    (tmp_path / "rat_hippocampus" / "_cache").write_text("")
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        for split in ["train", "test"]:
+            dataset = hippocampus.SingleRatTrialSplitDataset(name="synthetic",
+                                                             split=split,
+                                                             root=str(tmp_path))
+            assert len(dataset) == len(dataset.selected_indices)
+    messages = [str(w.message) for w in caught]
+    assert len(messages) == 1
+    assert "Could not cache" in messages[0]
+
+
+@pytest.mark.parametrize("use_env", [False, True])
+def test_hippocampus_split_cache_dir(tmp_path, monkeypatch, use_env):
+    from cebra.datasets import hippocampus
+
+    monkeypatch.delenv(hippocampus._SPLIT_CACHE_DIR_ENV, raising=False)
+    _write_rat_recording(tmp_path)
+    default_cache_dir = tmp_path / "rat_hippocampus" / "_cache"
+
+    def _init(**kwargs):
+        return hippocampus.SingleRatTrialSplitDataset(name="synthetic",
+                                                      split="valid",
+                                                      root=str(tmp_path),
+                                                      **kwargs)
+
+    # Caching can be disabled.
+    if use_env:
+        monkeypatch.setenv(hippocampus._SPLIT_CACHE_DIR_ENV, "")
+        disabled = _init()
+    else:
+        disabled = _init(cache_dir=False)
+    assert disabled.cache_dir is None
+    assert not default_cache_dir.exists()
+
+    # The cache can be relocated.
+    cache_dir = tmp_path / "elsewhere"
+    if use_env:
+        monkeypatch.setenv(hippocampus._SPLIT_CACHE_DIR_ENV, str(cache_dir))
+        relocated = _init()
+    else:
+        relocated = _init(cache_dir=str(cache_dir))
+    assert len(list(cache_dir.glob("*.pt"))) == 1
+    assert not default_cache_dir.exists()
+    assert torch.equal(disabled.neural, relocated.neural)
+    assert torch.equal(disabled.index, relocated.index)
+
+
+def _reference_trial_split(neural, index, split_no, split):
+    """Trial split as originally implemented, one ``torch.cat`` per trial."""
+    import sklearn.model_selection
+
+    direction_change_idx = np.where(index[1:, 1] != index[:-1, 1])[0]
+    trial_change_idx = np.append(np.insert(direction_change_idx[1::2], 0, 0),
+                                 len(index))
+    total_trials_num = len(trial_change_idx) - 1
+
+    outer_folds = np.array_split(np.arange(total_trials_num), 3)
+    inner_folds = sklearn.model_selection.KFold(n_splits=3,
+                                                random_state=None,
+                                                shuffle=False)
+    train_trials, valid_trials, test_trials = [], [], []
+    for out_fold in outer_folds:
+        train_trial, val_test_trial = list(
+            inner_folds.split(out_fold))[split_no]
+        test_trial, valid_trial = np.array_split(val_test_trial, 2)
+        train_trials.extend(np.array(out_fold)[train_trial])
+        valid_trials.extend(np.array(out_fold)[valid_trial])
+        test_trials.extend(np.array(out_fold)[test_trial])
+
+    trials = {
+        "train": train_trials,
+        "valid": valid_trials,
+        "test": test_trials,
+        "all": np.arange(total_trials_num),
+        "wo_test": np.concatenate([train_trials, valid_trials]),
+    }[split]
+    selected_slices = tuple(
+        slice(trial_change_idx[i], trial_change_idx[i + 1]) for i in trials)
+    neural = torch.cat([neural[s] for s in selected_slices])
+    index = torch.cat([index[s] for s in selected_slices])
+    cumulated_len = np.cumsum(
+        [trial_change_idx[i + 1] - trial_change_idx[i] for i in trials])
+    concat_idx = cumulated_len[:-1][np.array(trials[:-1]) + 1 != trials[1:]]
+    return neural, index, selected_slices, concat_idx
+
+
+@pytest.mark.parametrize("split_no", [0, 1, 2])
+@pytest.mark.parametrize("split", ["train", "valid", "test", "all", "wo_test"])
+def test_hippocampus_trial_split(tmp_path, split_no, split):
+    from cebra.datasets import hippocampus
+
+    _write_rat_recording(tmp_path)
+    full = hippocampus.SingleRatDataset(name="synthetic", root=str(tmp_path))
+    neural, index, selected_slices, concat_idx = _reference_trial_split(
+        full.neural, full.index, split_no, split)
+
+    dataset = hippocampus.SingleRatTrialSplitDataset(name="synthetic",
+                                                     split_no=split_no,
+                                                     split=split,
+                                                     root=str(tmp_path))
+    assert torch.equal(dataset.neural, neural)
+    assert torch.equal(dataset.index, index)
+    assert np.array_equal(dataset.concat_idx, concat_idx)
+    assert [(s.start, s.stop) for s in dataset.selected_slices
+           ] == [(s.start, s.stop) for s in selected_slices]
+    assert len(dataset) == len(neural)
+
+
+def test_hippocampus_selected_indices(tmp_path):
+    from cebra.datasets import hippocampus
+
+    _write_rat_recording(tmp_path)
+    full = hippocampus.SingleRatDataset(name="synthetic", root=str(tmp_path))
+    dataset = hippocampus.SingleRatTrialSplitDataset(name="synthetic",
+                                                     split="valid",
+                                                     root=str(tmp_path))
+
+    assert dataset.selected_indices.dtype == torch.int64
+    assert torch.equal(dataset.neural, full.neural[dataset.selected_indices])
+    assert torch.equal(dataset.index, full.index[dataset.selected_indices])
+    slice_rows = np.concatenate(
+        [np.arange(s.start, s.stop) for s in dataset.selected_slices])
+    assert np.array_equal(slice_rows, dataset.selected_indices.numpy())
+
+
+def test_hippocampus_corrupt(tmp_path):
+    from cebra.datasets import hippocampus
+
+    _write_rat_recording(tmp_path)
+    full = hippocampus.SingleRatDataset(name="synthetic", root=str(tmp_path))
+
+    def _init(seed):
+        return hippocampus.SingleRatCorruptDataset(name="synthetic",
+                                                   seed=seed,
+                                                   root=str(tmp_path))
+
+    dataset = _init(seed=3)
+    assert torch.equal(dataset.neural, full.neural)
+    assert torch.equal(dataset.index, _init(seed=3).index)
+    assert not torch.equal(dataset.index, _init(seed=4).index)
+    assert not torch.equal(dataset.index, full.index)
+
+    # The label rows are permuted, not resampled.
+    order = torch.argsort(dataset.index[:, 0])
+    full_order = torch.argsort(full.index[:, 0])
+    assert torch.equal(dataset.index[order], full.index[full_order])
+
+
+@pytest.mark.parametrize("compress", [0, 3])
+def test_hippocampus_load(tmp_path, compress):
+
+    from cebra.datasets import hippocampus
+
+    path = _write_rat_recording(tmp_path, compress=compress)
+    data = joblib.load(path)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        dataset = hippocampus.SingleRatDataset(name="synthetic",
+                                               root=str(tmp_path))
+    assert hippocampus._is_compressed(str(path)) == (compress > 0)
+    assert dataset.neural.dtype == torch.float32
+    assert np.array_equal(dataset.neural.numpy(), data["spikes"])
+    assert np.allclose(dataset.index.numpy(), data["position"])